@@ -13,6 +13,7 @@ import scipy.stats
 import scipy.linalg
 from scipy.linalg import block_diag
 from scipy.sparse import hstack
+from scipy.sparse import identity
 
 try:
     # Python 3.x does not natively support xrange
@@ -31,6 +32,120 @@ min_comp_value = 1e-300
 # min_comp_value = 1e-16
 
 
+class IdentityMatrix(object):
+    """
+    Stand-in for a square, 2D scipy sparse identity matrix that does not store
+    any of its elements. It is meant for calculations, such as the derivative
+    of the MNL model's transformed utilities with respect to the systematic
+    utilities, where the identity matrix is only used in matrix products.
+    In such cases, `dot(other)` simply returns `other` instead of performing a
+    sparse matrix product.
+
+    Parameters
+    ----------
+    size : int.
+        Should be greater than zero. Denotes the number of rows (and columns)
+        of the identity matrix.
+    """
+    def __init__(self, size):
+        self.shape = (size, size)
+        self.ndim = 2
+
+        return None
+
+    @property
+    def T(self):
+        return self
+
+    def transpose(self):
+        """
+        Returns the identity matrix, which is its own transpose.
+        """
+        return self
+
+    def dot(self, other):
+        """
+        Returns `other`, the result of the identity matrix's product with it.
+        """
+        if other.shape[0] != self.shape[1]:
+            msg = "Dimension mismatch: {} and {}"
+            raise ValueError(msg.format(self.shape, other.shape))
+        return other
+
+    def toarray(self):
+        """
+        Returns the identity matrix as a 2D ndarray.
+        """
+        return np.identity(self.shape[0])
+
+    def tocsr(self):
+        """
+        Returns the identity matrix as a scipy sparse CSR matrix.
+        """
+        return identity(self.shape[0], format='csr')
+
+
+def get_exponent_bounds(dtype):
+    """
+    Determines the bounds on the values that will be exponentiated, and the
+    smallest value that computed probabilities will be allowed to take.
+
+    Parameters
+    ----------
+    dtype : numpy dtype.
+        The dtype of the array that will be exponentiated.
+
+    Returns
+    -------
+    bounds : tuple of three floats.
+        Contains `(min_exponent, max_exponent, min_prob)`. For double
+        precision or non-floating point arrays, these equal `min_exponent_val`,
+        `max_exponent_val`, and `min_comp_value`. For lower precision floating
+        point arrays, the bounds are tightened so that the exponentials, and
+        the sum of exponentials for each observation, remain finite and
+        non-zero.
+    """
+    if not np.issubdtype(dtype, np.floating):
+        return min_exponent_val, max_exponent_val, min_comp_value
+
+    # Leave room for the sum of many exponentials at the upper bound.
+    float_info = np.finfo(dtype)
+    max_exponent = min(max_exponent_val, float(np.log(float_info.max) - 9))
+    min_exponent = max(min_exponent_val, float(np.log(float_info.tiny)))
+    min_prob = max(min_comp_value, float(float_info.tiny))
+    return min_exponent, max_exponent, min_prob
+
+
+def shift_by_max_per_obs(utilities, rows_to_obs):
+    """
+    Subtracts, in place, the maximum value of `utilities` for each observation
+    from each of that observation's rows.
+
+    Parameters
+    ----------
+    utilities : 2D ndarray.
+        There should be one row per observation per available alternative.
+        Each column should contain a set of utilities for each row.
+    rows_to_obs : 2D ndarray or scipy sparse array.
+        There should be one row per observation per available alternative and
+        one column per observation. This matrix maps the rows of the design
+        matrix to the unique observations (on the columns).
+
+    Returns
+    -------
+    None. Since the utilities of each observation are shifted by a common
+    value, the probabilities computed from them are unchanged. The largest
+    shifted utility of each observation will be zero.
+    """
+    row_idx, obs_idx = rows_to_obs.nonzero()
+    obs_max = np.full((rows_to_obs.shape[1],) + utilities.shape[1:],
+                      -np.inf,
+                      dtype=utilities.dtype)
+    np.maximum.at(obs_max, obs_idx, utilities[row_idx])
+    utilities[row_idx] -= obs_max[obs_idx]
+    return None
+
+
 def calc_probabilities(beta,
                        design,
                        alt_IDs,
@@ -138,12 +253,20 @@ def calc_probabilities(beta,
                                               shape_params,
                                               intercept_params)
 
-    # The following commands are to guard against numeric under/over-flow
-    too_small_idx = transformed_utilities < min_exponent_val
-    too_large_idx = transformed_utilities > max_exponent_val
-
-    transformed_utilities[too_small_idx] = min_exponent_val
-    transformed_utilities[too_large_idx] = max_exponent_val
+    # The following commands are to guard against numeric under/over-flow.
+    # Lower precision utilities overflow far sooner than double precision
+    # ones, so instead of being clipped, they are shifted by the maximum
+    # utility of each observation when any of them are too large.
+    min_exponent, max_exponent, min_prob =\
+        get_exponent_bounds(transformed_utilities.dtype)
+    too_large_idx = transformed_utilities > max_exponent
+    if max_exponent < max_exponent_val and too_large_idx.any():
+        shift_by_max_per_obs(transformed_utilities, rows_to_obs)
+        too_large_idx = transformed_utilities > max_exponent
+    too_small_idx = transformed_utilities < min_exponent
+
+    transformed_utilities[too_small_idx] = min_exponent
+    transformed_utilities[too_large_idx] = max_exponent
 
     # Exponentiate the transformed utilities
     long_exponentials = np.exp(transformed_utilities)
@@ -160,7 +283,7 @@ def calc_probabilities(beta,
         long_probs = (long_exponentials / long_denominators).ravel()
 
     # Guard against underflow
-    long_probs[long_probs == 0] = min_comp_value
+    long_probs[long_probs == 0] = min_prob
 
     if chosen_row_to_obs is None:
         chosen_probs = None
@@ -809,26 +809,33 @@ def create_sparse_mapping(id_array, unique_ids=None):
     assert unique_ids.ndim == 1
     assert id_array.ndim == 1
 
-    # Figure out which ids in id_array are represented in unique_ids
-    represented_ids = np.in1d(id_array, unique_ids)
-    # Determine the number of rows in id_array that are in unique_ids
-    num_non_zero_rows = represented_ids.sum()
     # Figure out the dimensions of the resulting sparse matrix
     num_rows = id_array.size
     num_cols = unique_ids.size
+    # Locate each element of id_array amongst the unique ids, in a single
+    # vectorized pass, and figure out which ids in id_array are represented in
+    # unique_ids. Positions are clipped so that ids which are larger than all
+    # of the unique ids can still be looked up before being discarded.
+    if num_cols > 0:
+        sort_order = np.argsort(unique_ids)
+        sorted_positions =\
+            np.searchsorted(unique_ids, id_array, sorter=sort_order)
+        sorted_positions = np.clip(sorted_positions, 0, num_cols - 1)
+        col_indices = sort_order[sorted_positions]
+        represented_ids = unique_ids[col_indices] == id_array
+    else:
+        col_indices = np.zeros(num_rows, dtype=int)
+        represented_ids = np.zeros(num_rows, dtype=bool)
+    # Keep the column indices of the rows with non-zero entries
+    col_indices = col_indices[represented_ids]
     # Specify the non-zero values that will be present in the sparse matrix.
-    data = np.ones(num_non_zero_rows, dtype=int)
-    # Specify which rows will have non-zero entries in the sparse matrix.
-    row_indices = np.arange(num_rows)[represented_ids]
-    # Map the unique id's to their respective columns
-    unique_id_dict = dict(zip(unique_ids, np.arange(num_cols)))
-    # Figure out the column indices of the non-zero entries, and do so in a way
-    # that avoids a key error (i.e. only look up ids that are represented)
-    col_indices =\
-        np.array([unique_id_dict[x] for x in id_array[represented_ids]])
+    data = np.ones(col_indices.size, dtype=int)
+    # Each row has at most one non-zero entry, so the row pointers are given
+    # by the cumulative count of represented rows.
+    indptr = np.concatenate(([0], np.cumsum(represented_ids)))
 
     # Create and return the sparse matrix
-    return csr_matrix((data, (row_indices, col_indices)),
+    return csr_matrix((data, col_indices, indptr),
                       shape=(num_rows, num_cols))
 
 
@@ -14,7 +14,6 @@ from __future__ import absolute_import
 
 import warnings
 import numpy as np
-from scipy.sparse import diags
 
 from . import choice_calcs as cc
 from . import base_multinomial_cm_v2 as base_mcm
@@ -176,8 +175,10 @@ class MNLEstimator(LogitTypeEstimator):
     """
     def set_derivatives(self):
         # Pre-calculate the derivative of the transformation vector with
-        # respect to the vector of systematic utilities
-        dh_dv = diags(np.ones(self.design.shape[0]), 0, format='csr')
+        # respect to the vector of systematic utilities. This derivative is
+        # the identity matrix, so avoid performing sparse matrix products with
+        # it.
+        dh_dv = cc.IdentityMatrix(self.design.shape[0])
 
         # Create a function to calculate dh_dv which will return the
         # pre-calculated result when called
@@ -26,6 +26,7 @@ from . import mixed_logit_calcs as mlc
 from .choice_tools import get_dataframe_from_data
 from .choice_tools import create_design_matrix
 from .choice_tools import create_long_form_mappings
+from .choice_tools import create_sparse_mapping
 from .display_names import model_type_to_display_name
 from .estimation import EstimationObj
 from .estimation import estimate
@@ -237,6 +238,10 @@ class MixedEstimator(EstimationObj):
         # Add the 3d design matrix to the object
         self.design_3d = model_obj.design_3d
 
+        # Initialize the storage for the most recently calculated scaled errors
+        # so the gradient and the BHHH approximation can share them.
+        self.scaled_error_cache = None
+
         return None
 
     def convenience_split_params(self, params, return_all_types=False):
@@ -287,6 +292,35 @@ class MixedEstimator(EstimationObj):
 
         return probability_results
 
+    def convenience_calc_scaled_errors(self, params):
+        """
+        Calculates the scaled errors that are used by both the gradient and
+        the BHHH approximation for this model / dataset. The results for the
+        most recent `params` are cached so that evaluating the gradient and the
+        BHHH approximation at the same parameters only computes them once.
+        """
+        shapes, intercepts, betas = self.convenience_split_params(params)
+
+        if self.scaled_error_cache is not None:
+            cached_betas, cached_scaled_error = self.scaled_error_cache
+            if np.array_equal(cached_betas, betas):
+                return cached_scaled_error
+
+        prob_array = general_calc_probabilities(betas,
+                                                self.design_3d,
+                                                self.alt_id_vector,
+                                                self.rows_to_obs,
+                                                self.rows_to_alts,
+                                                self.utility_transform,
+                                                return_long_probs=True)
+        scaled_error = mlc.calc_scaled_errors(prob_array,
+                                              self.choice_vector,
+                                              self.rows_to_mixers)
+
+        self.scaled_error_cache = (np.array(betas, copy=True), scaled_error)
+
+        return scaled_error
+
     def convenience_calc_log_likelihood(self, params):
         """
         Calculates the log-likelihood for this model and dataset.
@@ -322,7 +356,10 @@ class MixedEstimator(EstimationObj):
                 self.choice_vector,
                 self.utility_transform]
 
-        return general_gradient(*args, ridge=self.ridge, weights=self.weights)
+        kwargs = {"ridge": self.ridge,
+                  "weights": self.weights,
+                  "scaled_error": self.convenience_calc_scaled_errors(params)}
+        return general_gradient(*args, **kwargs)
 
     def convenience_calc_hessian(self, params):
         """
@@ -342,8 +379,10 @@ class MixedEstimator(EstimationObj):
                 self.choice_vector,
                 self.utility_transform]
 
-        approx_hess =\
-            general_bhhh(*args, ridge=self.ridge, weights=self.weights)
+        kwargs = {"ridge": self.ridge,
+                  "weights": self.weights,
+                  "scaled_error": self.convenience_calc_scaled_errors(params)}
+        approx_hess = general_bhhh(*args, **kwargs)
 
         # Account for the constrained position when presenting the results of
         # the approximate hessian.
@@ -439,7 +478,8 @@ class MixedLogit(base_mcm.MNDC_Model):
 
     Methods
     -------
-    panel_predict(new_data, num_draws, return_long_probs, choice_col, seed)
+    panel_predict(new_data, num_draws, return_long_probs, choice_col, seed,
+                  draw_type, dtype)
         Predicts the probability of each individual in `new_data` making each
         possible choice in each choice situation they are faced with. This
         method differs from the `predict()` function by using 'individualized
@@ -500,6 +540,7 @@ class MixedLogit(base_mcm.MNDC_Model):
                 maxiter=1000,
                 ridge=None,
                 just_point=False,
+                draw_type="pseudo",
                 **kwargs):
         """
         Parameters
@@ -548,6 +589,10 @@ class MixedLogit(base_mcm.MNDC_Model):
             critical for obtaining the maximum likelihood point estimate will
             be performed. If True, this function will return the results
             dictionary from scipy.optimize. Default == False.
+        draw_type : {'pseudo', 'halton'}, optional.
+            Determines whether psuedo-random draws or randomized Halton draws
+            are taken from the mixing distributions. Halton draws typically
+            need fewer draws for the same accuracy. Default == 'pseudo'.
 
         Returns
         -------
@@ -579,7 +624,8 @@ class MixedLogit(base_mcm.MNDC_Model):
         draw_list = mlc.get_normal_draws(num_mixing_units,
                                          num_draws,
                                          len(self.mixing_pos),
-                                         seed=seed)
+                                         seed=seed,
+                                         draw_type=draw_type)
 
         # Create the 3D design matrix
         self.design_3d = mlc.create_expanded_design_for_mixing(self.design,
@@ -658,23 +704,16 @@ class MixedLogit(base_mcm.MNDC_Model):
             if past_mappings[key] is None:
                 new_mappings[key] = None
             else:
-                mask_array = long_inclusion_array[:, None]
-                orig_map = past_mappings[key]
-                # Initialize the resultant array that is desired
-                new_map = orig_map.multiply(np.tile(mask_array,
-                                                    (1, orig_map.shape[1]))).A
-                # Perform the desired filtering
-                current_filter = (new_map.sum(axis=1) != 0)
-                if current_filter.shape[0] > 0:
-                    current_filter = current_filter.ravel()
-                    new_map = new_map[current_filter, :]
-                # Do the second filtering
-                current_filter = (new_map.sum(axis=0) != 0)
-                if current_filter.shape[0] > 0:
-                    current_filter = current_filter.ravel()
-                    new_map = new_map[:, current_filter]
-
-                new_mappings[key] = csr_matrix(new_map)
+                # Keep the rows that are to be included, without creating a
+                # dense copy of the mapping matrix.
+                row_filter = np.asarray(long_inclusion_array, dtype=bool)
+                new_map = csr_matrix(past_mappings[key])[row_filter]
+                new_map.eliminate_zeros()
+                # Drop the rows and columns that no longer map to anything.
+                new_map = new_map[new_map.getnnz(axis=1) > 0]
+                new_map = new_map[:, new_map.getnnz(axis=0) > 0]
+
+                new_mappings[key] = new_map
 
         return new_mappings
 
@@ -683,7 +722,9 @@ class MixedLogit(base_mcm.MNDC_Model):
                       num_draws,
                       return_long_probs=True,
                       choice_col=None,
-                      seed=None):
+                      seed=None,
+                      draw_type="pseudo",
+                      dtype=np.float64):
         """
         Parameters
         ----------
@@ -712,6 +753,18 @@ class MixedLogit(base_mcm.MNDC_Model):
             value to be used in seeding the random generator used to generate
             the draws from the mixing distributions of each random coefficient.
             Default == None.
+        draw_type : {'pseudo', 'halton'}, optional.
+            Determines whether psuedo-random draws or randomized Halton draws
+            are taken from the mixing distributions. Default == 'pseudo'.
+        dtype : numpy floating point dtype, optional.
+            Determines the precision of the design matrices, coefficients,
+            draws, and mapping matrices used to compute the kernel
+            probabilities, and of the returned probabilities. Passing
+            `np.float32` halves the memory needed for the 3D design matrices
+            and kernel probabilities, at the cost of single precision results.
+            The probabilities of each mixing unit's past choice sequence, used
+            to weight the draws, are always computed in double precision.
+            Default == np.float64.
 
         Returns
         -------
@@ -741,6 +794,9 @@ class MixedLogit(base_mcm.MNDC_Model):
         if choice_col is None and not return_long_probs:
             msg = "choice_col is None AND return_long_probs == False"
             raise ValueError(msg)
+        if not np.issubdtype(dtype, np.floating):
+            msg = "dtype must be a floating point dtype."
+            raise ValueError(msg)
 
         # Get the dataframe of observations we'll be predicting on
         dataframe = get_dataframe_from_data(data)
@@ -768,7 +824,7 @@ class MixedLogit(base_mcm.MNDC_Model):
                                               self.specification,
                                               self.alt_id_col,
                                               names=self.name_spec)
-        new_design_2d = new_design_res[0]
+        new_design_2d = new_design_res[0].astype(dtype)
 
         # Get the new mappings between the alternatives and observations
         mapping_res = create_long_form_mappings(dataframe,
@@ -778,15 +834,19 @@ class MixedLogit(base_mcm.MNDC_Model):
                                                 nest_spec=self.nest_spec,
                                                 mix_id_col=self.mixing_id_col)
 
-        new_rows_to_obs = mapping_res["rows_to_obs"]
-        new_rows_to_alts = mapping_res["rows_to_alts"]
+        # Note the mappings are cast to dtype so that their products with the
+        # kernel probabilities are not upcast to double precision.
+        new_rows_to_obs = mapping_res["rows_to_obs"].astype(dtype)
+        new_rows_to_alts = mapping_res["rows_to_alts"].astype(dtype)
         new_chosen_to_obs = mapping_res["chosen_row_to_obs"]
-        new_rows_to_mixers = mapping_res["rows_to_mixers"]
+        if new_chosen_to_obs is not None:
+            new_chosen_to_obs = new_chosen_to_obs.astype(dtype)
+        new_rows_to_mixers = mapping_res["rows_to_mixers"].astype(dtype)
 
         # Determine the coefficients being used for prediction.
         # Note that I am making an implicit assumption (for now) that the
         # kernel probabilities are coming from a logit-type model.
-        new_index_coefs = self.coefs.values
+        new_index_coefs = self.coefs.values.astype(dtype)
         new_intercepts = (self.intercepts.values if self.intercepts
                           is not None else None)
         new_shape_params = (self.shapes.values if self.shapes
@@ -797,7 +857,9 @@ class MixedLogit(base_mcm.MNDC_Model):
         draw_list = mlc.get_normal_draws(num_mixing_units,
                                          num_draws,
                                          len(self.mixing_pos),
-                                         seed=seed)
+                                         seed=seed,
+                                         draw_type=draw_type)
+        draw_list = [draws.astype(dtype) for draws in draw_list]
 
         # Calculate the 3D design matrix for the prediction.
         design_args = (new_design_2d,
@@ -823,9 +885,9 @@ class MixedLogit(base_mcm.MNDC_Model):
         # Initialize and calculate the weights needed for prediction with
         # "individualized" coefficient distributions. Should have shape
         # (new_row_to_mixer.shape[1], num_draws)
-        weights_per_ind_per_draw = (1.0 / num_draws *
-                                    np.ones((new_rows_to_mixers.shape[1],
-                                             num_draws)))
+        weights_per_ind_per_draw = (np.ones((new_rows_to_mixers.shape[1],
+                                             num_draws),
+                                            dtype=dtype) / num_draws)
 
         ##########
         # Create an array denoting the observation ids that are present in both
@@ -846,18 +908,22 @@ class MixedLogit(base_mcm.MNDC_Model):
 
         # Figure out which long format rows have ids are common to both
         # datasets
-        old_repeat_mixing_id_idx = np.in1d(old_mixing_id_long,
+        old_repeat_mixing_id_idx = np.isin(old_mixing_id_long,
                                            orig_order_unique_ids_new)
-        # Figure out which unique ids are in both datasets
-        old_unique_mix_id_repeats = np.in1d(orig_order_unique_ids_old,
-                                            orig_order_unique_ids_new)
-        new_unique_mix_id_repeats = np.in1d(orig_order_unique_ids_new,
-                                            orig_order_unique_ids_old)
+        # Figure out which unique ids are in both datasets. Both arrays of ids
+        # are unique, so we can skip the uniqueness checks in np.isin.
+        old_unique_mix_id_repeats = np.isin(orig_order_unique_ids_old,
+                                            orig_order_unique_ids_new,
+                                            assume_unique=True)
+        new_unique_mix_id_repeats = np.isin(orig_order_unique_ids_new,
+                                            orig_order_unique_ids_old,
+                                            assume_unique=True)
 
         # Get the 2d design matrix used to estimate the model, and filter it
         # to only those individuals for whom we are predicting new choice
         # situations.
-        past_design_2d = self.design[old_repeat_mixing_id_idx, :]
+        past_design_2d =\
+            self.design[old_repeat_mixing_id_idx, :].astype(dtype)
 
         ##########
         # Appropriately filter the old mapping matrix that maps rows of the
@@ -866,6 +932,9 @@ class MixedLogit(base_mcm.MNDC_Model):
         orig_mappings = self.get_mappings_for_fit()
         past_mappings = self.__filter_past_mappings(orig_mappings,
                                                     old_repeat_mixing_id_idx)
+        past_rows_to_obs = past_mappings["rows_to_obs"].astype(dtype)
+        past_rows_to_alts = past_mappings["rows_to_alts"].astype(dtype)
+        past_rows_to_mixers = past_mappings["rows_to_mixers"].astype(dtype)
 
         # Create the 3D design matrix for those choice situations, using the
         # draws that were just taken from the mixing distributions of interest.
@@ -873,7 +942,7 @@ class MixedLogit(base_mcm.MNDC_Model):
         design_args = (past_design_2d,
                        past_draw_list,
                        self.mixing_pos,
-                       past_mappings["rows_to_mixers"])
+                       past_rows_to_mixers)
         past_design_3d = mlc.create_expanded_design_for_mixing(*design_args)
 
         # Get the kernel probabilities of each of the alternatives for each
@@ -882,8 +951,8 @@ class MixedLogit(base_mcm.MNDC_Model):
         prob_args = (new_index_coefs,
                      past_design_3d,
                      self.alt_IDs[old_repeat_mixing_id_idx],
-                     past_mappings["rows_to_obs"],
-                     past_mappings["rows_to_alts"],
+                     past_rows_to_obs,
+                     past_rows_to_alts,
                      mnl_utility_transform)
         prob_kwargs = {"return_long_probs": True}
         past_kernel_probs = mlc.general_calc_probabilities(*prob_args,
@@ -897,7 +966,7 @@ class MixedLogit(base_mcm.MNDC_Model):
         past_choices = self.choices[old_repeat_mixing_id_idx]
         sequence_args = (past_kernel_probs,
                          past_choices,
-                         past_mappings["rows_to_mixers"])
+                         past_rows_to_mixers)
         seq_kwargs = {"return_type": 'all'}
         old_sequence_results = mlc.calc_choice_sequence_probs(*sequence_args,
                                                               **seq_kwargs)
@@ -910,13 +979,9 @@ class MixedLogit(base_mcm.MNDC_Model):
         # Rearrange the past weights to match the current ordering of the
         # unique observations
         rel_new_ids = orig_order_unique_ids_new[new_unique_mix_id_repeats]
-        num_rel_new_id = rel_new_ids.shape[0]
-        new_unique_mix_id_repeats_2d = rel_new_ids.reshape((num_rel_new_id, 1))
         rel_old_ids = orig_order_unique_ids_old[old_unique_mix_id_repeats]
-        num_rel_old_id = rel_old_ids.shape[0]
-        old_unique_mix_id_repeats_2d = rel_old_ids.reshape((1, num_rel_old_id))
-        new_to_old_repeat_ids = csr_matrix(new_unique_mix_id_repeats_2d ==
-                                           old_unique_mix_id_repeats_2d)
+        new_to_old_repeat_ids = create_sparse_mapping(rel_new_ids,
+                                                      unique_ids=rel_old_ids)
         past_weights = new_to_old_repeat_ids.dot(past_weights)
 
         # Map these weights to earlier initialized weights
@@ -928,8 +993,13 @@ class MixedLogit(base_mcm.MNDC_Model):
         weights_per_draw = new_rows_to_mixers.dot(weights_per_ind_per_draw)
 
         # Calculate the predicted probabilities of each alternative for each
-        # choice situation being predicted
-        pred_probs_long = (weights_per_draw * new_kernel_probs).sum(axis=1)
+        # choice situation being predicted. Note that the kernel probabilities
+        # are 1D when only one draw is used.
+        if new_kernel_probs.ndim == 1:
+            new_kernel_probs = new_kernel_probs[:, None]
+        pred_probs_long = np.einsum('id,id->i',
+                                    weights_per_draw,
+                                    new_kernel_probs)
         # Note I am assuming pred_probs_long should be 1D (as should be the
         # case if we are predicting with one set of betas and one 2D data
         # object)
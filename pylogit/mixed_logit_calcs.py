@@ -14,8 +14,7 @@ Current Assumptions (to be relaxed later):
     - The number of draws from each parameter's distributions must be equal.
     - Only the normal distribution is supported as a mixing distribution
       (at the moment).
-    - Only psuedo-random draws are supported at the moment. Halton draws are
-      not yet supported.
+    - Draws are either psuedo-random or randomized Halton draws.
     - It is assumed that individuals are the units being mixed over
       (i.e. parameters are randomly distributed over observations).
 """
@@ -23,14 +22,9 @@ from __future__ import absolute_import
 
 import scipy.stats
 import numpy as np
+from scipy.sparse import csr_matrix
 from . import choice_calcs as cc
 
-try:
-    # Python 3.x does support xrange
-    from past.builtins import xrange
-except ImportError:
-    pass
-
 
 # Define the boundary values which are not to be exceeded ducing computation
 min_exponent_val = -700
@@ -43,10 +37,107 @@ min_comp_value = 1e-300
 general_calc_probabilities = cc.calc_probabilities
 
 
+def get_primes(num_primes):
+    """
+    Parameters
+    ----------
+    num_primes : int.
+        Should be greater than zero. Denotes the number of prime numbers to
+        return.
+
+    Returns
+    -------
+    primes : list of ints.
+        The first `num_primes` prime numbers, in ascending order.
+    """
+    primes = []
+    candidate = 2
+    while len(primes) < num_primes:
+        if all(candidate % prime != 0 for prime in primes):
+            primes.append(candidate)
+        candidate += 1
+    return primes
+
+
+def calc_radical_inverse(indices, base):
+    """
+    Parameters
+    ----------
+    indices : 1D ndarray of ints.
+        All elements should be greater than or equal to zero. Denotes the
+        positions in the van der Corput sequence that are desired.
+    base : int.
+        Should be a prime number. Denotes the base of the van der Corput
+        sequence.
+
+    Returns
+    -------
+    sequence : 1D ndarray of floats.
+        All elements will be in [0, 1). Each element will be the radical
+        inverse of the corresponding element of `indices` in the given base,
+        i.e. the digits of the index in `base` are mirrored about the decimal
+        point.
+    """
+    sequence = np.zeros(indices.shape[0])
+    remaining = np.array(indices, dtype=int)
+    fraction = 1.0 / base
+    while (remaining > 0).any():
+        sequence += fraction * (remaining % base)
+        remaining //= base
+        fraction /= base
+    return sequence
+
+
+def get_halton_draws(num_mixers,
+                     num_draws,
+                     num_vars,
+                     num_burn=10):
+    """
+    Parameters
+    ----------
+    num_mixers : int.
+        Should be greater than zero. Denotes the number of observations for
+        which we are making Halton draws.
+    num_draws : int.
+        Should be greater than zero. Denotes the number of draws that are to be
+        made for each observation.
+    num_vars : int.
+        Should be greater than zero. Denotes the number of variables for which
+        we need to take Halton draws.
+    num_burn : int, optional.
+        Should be greater than or equal to zero. Denotes the number of initial
+        elements of each Halton sequence that are discarded. Default == 10.
+
+    Returns
+    -------
+    all_draws : list of 2D ndarrays.
+        The list will have num_vars elements. Each element will be a
+        num_mixers by num_draws numpy array of randomly shifted Halton draws in
+        (0, 1). Each variable uses a Halton sequence with a different prime
+        base, and each mixing unit uses `num_draws` consecutive elements of
+        that sequence.
+        The shift is drawn from numpy's global random number generator.
+    """
+    indices = np.arange(num_burn, num_burn + num_mixers * num_draws)
+    all_draws = []
+    for base in get_primes(num_vars):
+        halton_seq = calc_radical_inverse(indices, base)
+        # Randomly shift the sequence (modulo one) so that repeated calls give
+        # different, but still evenly spread, draws.
+        shifted_seq = np.mod(halton_seq + np.random.uniform(), 1.0)
+        # Keep the draws away from zero and one so their normal quantiles are
+        # finite.
+        eps = np.finfo(float).eps
+        shifted_seq = np.clip(shifted_seq, eps, 1 - eps)
+        all_draws.append(shifted_seq.reshape((num_mixers, num_draws)))
+    return all_draws
+
+
 def get_normal_draws(num_mixers,
                      num_draws,
                      num_vars,
-                     seed=None):
+                     seed=None,
+                     draw_type="pseudo"):
     """
     Parameters
     ----------
@@ -64,6 +155,12 @@ def get_normal_draws(num_mixers,
         If an int is passed, it should be greater than zero. Denotes the value
         to be used in seeding the random generator used to generate the draws
         from the normal distribution. Default == None.
+    draw_type : {'pseudo', 'halton'}, optional.
+        Determines whether psuedo-random draws or randomized Halton draws (i.e.
+        quasi-random draws) are taken. Halton draws cover the normal
+        distribution more evenly, so fewer draws are needed to achieve the same
+        accuracy when simulating the choice probabilities.
+        Default == 'pseudo'.
 
     Returns
     -------
@@ -77,13 +174,20 @@ def get_normal_draws(num_mixers,
     assert all([x > 0 for x in [num_mixers, num_draws, num_vars]])
     if seed is not None:
         assert isinstance(seed, int) and seed > 0
+    if draw_type not in ["pseudo", "halton"]:
+        raise ValueError("draw_type must be 'pseudo' or 'halton'.")
 
     normal_dist = scipy.stats.norm(loc=0.0, scale=1.0)
     all_draws = []
     if seed:
         np.random.seed(seed)
-    for i in xrange(num_vars):
-        all_draws.append(normal_dist.rvs(size=(num_mixers, num_draws)))
+    if draw_type == "halton":
+        uniform_draws = get_halton_draws(num_mixers, num_draws, num_vars)
+        for draws in uniform_draws:
+            all_draws.append(normal_dist.ppf(draws))
+    else:
+        for i in range(num_vars):
+            all_draws.append(normal_dist.rvs(size=(num_mixers, num_draws)))
     return all_draws
 
 
@@ -105,6 +209,31 @@ def convert_mixing_names_to_positions(mixing_names, ind_var_names):
     return [ind_var_names.index(name) for name in mixing_names]
 
 
+def get_row_to_mixer_positions(rows_to_mixers):
+    """
+    Parameters
+    ----------
+    rows_to_mixers : 2D scipy sparse array.
+        All elements should be zeros and ones. Will map the rows of the design
+        matrix to the particular units that the mixing is being performed over.
+        Note that in the case of panel data, this matrix will be different from
+        `rows_to_obs`.
+
+    Returns
+    -------
+    mixer_positions : 1D ndarray of ints, or None.
+        If every row of `rows_to_mixers` contains exactly one non-zero element
+        and that element is a one, then `mixer_positions[i]` will be the column
+        (i.e. the mixing unit) that row `i` is mapped to. Otherwise, None will
+        be returned.
+    """
+    mapping = csr_matrix(rows_to_mixers)
+    one_entry_per_row = (np.diff(mapping.indptr) == 1).all()
+    if one_entry_per_row and (mapping.data == 1).all():
+        return mapping.indices
+    return None
+
+
 def create_expanded_design_for_mixing(design,
                                       draw_list,
                                       mixing_pos,
@@ -147,14 +276,18 @@ def create_expanded_design_for_mixing(design,
     num_draws = draw_list[0].shape[1]
     orig_num_vars = design.shape[1]
 
-    # Initialize the expanded design matrix that replicates the columns of the
-    # variables that are being mixed over.
-    arrays_for_mixing = design[:, mixing_pos]
-    expanded_design = np.concatenate((design, arrays_for_mixing),
-                                     axis=1).copy()
-    design_3d = np.repeat(expanded_design[:, None, :],
-                          repeats=num_draws,
-                          axis=1)
+    # Allocate the expanded design matrix once, with one extra column for each
+    # variable being mixed over, and fill in the original variables for every
+    # draw.
+    num_rows = design.shape[0]
+    num_vars = orig_num_vars + len(mixing_pos)
+    design_3d = np.empty((num_rows, num_draws, num_vars),
+                         dtype=np.result_type(design, *draw_list))
+    design_3d[:, :, :orig_num_vars] = design[:, None, :]
+
+    # Determine the mixing unit of each row so that each row's draws can be
+    # gathered directly instead of through a sparse matrix product.
+    mixer_positions = get_row_to_mixer_positions(rows_to_mixers)
 
     # Multiply the columns that are being mixed over by their appropriate
     # draws from the normal distribution
@@ -162,7 +295,10 @@ def create_expanded_design_for_mixing(design,
         rel_draws = draw_list[pos]
         # Note that rel_long_draws will be a dense, 2D numpy array of shape
         # (num_rows, num_draws).
-        rel_long_draws = rows_to_mixers.dot(rel_draws)
+        if mixer_positions is not None:
+            rel_long_draws = np.take(rel_draws, mixer_positions, axis=0)
+        else:
+            rel_long_draws = rows_to_mixers.dot(rel_draws)
         # Create the actual column in design 3d that should be used.
         # It should be the multiplication of the draws random variable and the
         # independent variable associated with the param that is being mixed.
@@ -172,7 +308,8 @@ def create_expanded_design_for_mixing(design,
         # orig_num_vars + pos since the variables being mixed over were added,
         # in order so we simply need to start at the first position after all
         # the original variables (i.e. at orig_num_vars) and iterate.
-        design_3d[:, :, orig_num_vars + pos] *= rel_long_draws
+        design_3d[:, :, orig_num_vars + pos] = (design[:, idx, None] *
+                                                rel_long_draws)
 
     return design_3d
 
@@ -184,13 +321,14 @@ def calc_choice_sequence_probs(prob_array,
     """
     Parameters
     ----------
-    prob_array : 2D ndarray.
+    prob_array : 1D or 2D ndarray.
         All elements should be ints, floats, or longs. All elements should be
         between zero and one (exclusive). Each element should represent the
         probability of the corresponding alternative being chosen by the
         corresponding individual during the given choice situation, given the
         particular draw of coefficients being considered. There should be one
-        column for each draw of the coefficients.
+        column for each draw of the coefficients. A 1D array is treated as
+        having a single draw.
     choice_vec : 1D ndarray.
         All elements should be zeros or ones. Should denote the rows that were
         chosen by the individuals corresponding to those rows.
@@ -219,11 +357,21 @@ def calc_choice_sequence_probs(prob_array,
     if return_type not in [None, 'all']:
         raise ValueError("return_type must be None or 'all'.")
 
-    log_chosen_prob_array = choice_vec[:, None] * np.log(prob_array)
+    # Treat the 1D probabilities that result from a single draw as one column
+    if prob_array.ndim == 1:
+        prob_array = prob_array[:, None]
+
+    # Only the chosen rows contribute to the probability of each sequence of
+    # choices, so only take the logs of the probabilities in those rows.
+    chosen_idx = np.flatnonzero(choice_vec)
+    log_chosen_prob_array = (choice_vec[chosen_idx, None] *
+                             np.log(prob_array[chosen_idx]))
     # Create a 2D array with shape (num_mixing_units, num_random_draws)
     # Each element will be the log of the probability of the sequence of
     # choices, given the random draw of the coefficients
-    expanded_log_sequence_probs = rows_to_mixers.T.dot(log_chosen_prob_array)
+    chosen_rows_to_mixers = rows_to_mixers[chosen_idx]
+    expanded_log_sequence_probs =\
+        chosen_rows_to_mixers.T.dot(log_chosen_prob_array)
     # Calculate the probability of the sequence of choices for each mixing
     # unit, given the random draw of the coefficients
     expanded_sequence_probs = np.exp(expanded_log_sequence_probs)
@@ -240,6 +388,63 @@ def calc_choice_sequence_probs(prob_array,
         return sequence_probs, expanded_sequence_probs
 
 
+def calc_scaled_errors(prob_array, choice_vector, rows_to_mixers):
+    """
+    Parameters
+    ----------
+    prob_array : 2D ndarray.
+        All elements should be ints, floats, or longs. All elements should be
+        between zero and one (exclusive). Each element should represent the
+        probability of the corresponding alternative being chosen by the
+        corresponding individual during the given choice situation, given the
+        particular draw of coefficients being considered. There should be one
+        column for each draw of the coefficients.
+    choice_vector : 1D ndarray.
+        All elements should be either ones or zeros. There should be one row
+        per observation per available alternative for the given observation.
+        Elements denote the alternative which is chosen by the given
+        observation with a 1 and a zero otherwise.
+    rows_to_mixers : 2D scipy sparse array.
+        All elements should be zeros and ones. Will map the rows of the design
+        matrix to the particular units that the mixing is being performed over.
+        Note that in the case of panel data, this matrix will be different from
+        `rows_to_obs`.
+
+    Returns
+    -------
+    scaled_error : 2D ndarray of shape `(num_rows, num_draws)`.
+        Each element is the difference between the choice indicator and the
+        kernel probability of the given row and draw, multiplied by the
+        ratio of the probability of the mixing unit's sequence of choices given
+        that draw to the simulated probability of the sequence of choices.
+        This is the quantity that is shared by the gradient and the BHHH
+        approximation of the mixed logit log-likelihood.
+    """
+    # Calculate the simulated probability of correctly predicting each persons
+    # sequence of choices. Note that this function implicitly assumes that the
+    # mixing unit is the individual
+    prob_results = calc_choice_sequence_probs(prob_array,
+                                              choice_vector,
+                                              rows_to_mixers,
+                                              return_type="all")
+    # Calculate the sequence probabilities given random draws
+    # and calculate the overal simulated probabilities
+    sequence_prob_array = prob_results[1]
+    simulated_probs = prob_results[0]
+
+    # Scale sequence probabilites given random draws by simulated probabilities
+    # and convert the scaled probabilities to long format
+    scaled_sequence_probs =\
+        rows_to_mixers.dot(sequence_prob_array / simulated_probs[:, None])
+    # Calculate the scaled error. Will have shape == (num_rows, num_draws).
+    # Note the scaling is done in place to avoid allocating another array of
+    # that shape.
+    scaled_error = choice_vector[:, None] - prob_array
+    scaled_error *= scaled_sequence_probs
+
+    return scaled_error
+
+
 def calc_mixed_log_likelihood(params,
                               design_3d,
                               alt_IDs,
@@ -357,7 +562,8 @@ def calc_mixed_logit_gradient(params,
                               choice_vector,
                               utility_transform,
                               ridge=None,
-                              weights=None):
+                              weights=None,
+                              scaled_error=None):
     """
     Parameters
     ----------
@@ -414,6 +620,11 @@ def calc_mixed_logit_gradient(params,
         relation to the proportion of observations in that strata in the
         population. In latent class models, the weights may be the probability
         of being a particular class.
+    scaled_error : 2D ndarray or None, optional.
+        If an array is passed, it should be the output of
+        `calc_scaled_errors()` evaluated at `params`, and it will be used
+        instead of recalculating the probabilities and scaled errors.
+        Default == None.
 
     Returns
     -------
@@ -425,48 +636,31 @@ def calc_mixed_logit_gradient(params,
     if weights is None:
         weights = np.ones(design_3d.shape[0])
 
-    # Calculate the regular probability array. Note the implicit assumption
-    # that params == index coefficients.
-    prob_array = general_calc_probabilities(params,
-                                            design_3d,
-                                            alt_IDs,
-                                            rows_to_obs,
-                                            rows_to_alts,
-                                            utility_transform,
-                                            return_long_probs=True)
-
-    # Calculate the simulated probability of correctly predicting each persons
-    # sequence of choices. Note that this function implicitly assumes that the
-    # mixing unit is the individual
-    prob_results = calc_choice_sequence_probs(prob_array,
-                                              choice_vector,
-                                              rows_to_mixers,
-                                              return_type="all")
-    # Calculate the sequence probabilities given random draws
-    # and calculate the overal simulated probabilities
-    sequence_prob_array = prob_results[1]
-    simulated_probs = prob_results[0]
-
-    # Convert the various probabilties to long format
-    long_sequence_prob_array = rows_to_mixers.dot(sequence_prob_array)
-    long_simulated_probs = rows_to_mixers.dot(simulated_probs)
-    # Scale sequence probabilites given random draws by simulated probabilities
-    scaled_sequence_probs = (long_sequence_prob_array /
-                             long_simulated_probs[:, None])
-    # Calculate the scaled error. Will have shape == (num_rows, num_draws)
-    scaled_error = ((choice_vector[:, None] - prob_array) *
-                    scaled_sequence_probs)
+    if scaled_error is None:
+        # Calculate the regular probability array. Note the implicit
+        # assumption that params == index coefficients.
+        prob_array = general_calc_probabilities(params,
+                                                design_3d,
+                                                alt_IDs,
+                                                rows_to_obs,
+                                                rows_to_alts,
+                                                utility_transform,
+                                                return_long_probs=True)
+        # Calculate the scaled error. Will have shape == (num_rows, num_draws)
+        scaled_error = calc_scaled_errors(prob_array,
+                                          choice_vector,
+                                          rows_to_mixers)
 
     # Calculate the gradient. Note that the lines below assume that we are
     # taking the gradient of an MNL model. Should refactor to make use of the
     # built in gradient function for logit-type models. Should also refactor
     # the gradient function for logit-type models to be able to handle 2D
-    # systematic utility arrays.
-    gradient = (scaled_error[:, :, None] *
-                design_3d *
-                weights[:, None, None]).sum(axis=0)
-
-    gradient = gradient.mean(axis=0)
+    # systematic utility arrays. The contraction sums over both the rows and
+    # the draws, so we divide by the number of draws to average over them.
+    gradient = (np.einsum('id,idk->k',
+                          scaled_error * weights[:, None],
+                          design_3d) /
+                design_3d.shape[1])
 
     # Account for the ridge parameter if an L2 penalization is being performed
     if ridge is not None:
@@ -594,7 +788,8 @@ def calc_bhhh_hessian_approximation_mixed_logit(params,
                                                 choice_vector,
                                                 utility_transform,
                                                 ridge=None,
-                                                weights=None):
+                                                weights=None,
+                                                scaled_error=None):
     """
     Parameters
     ----------
@@ -651,6 +846,11 @@ def calc_bhhh_hessian_approximation_mixed_logit(params,
         relation to the proportion of observations in that strata in the
         population. In latent class models, the weights may be the probability
         of being a particular class. Default == None.
+    scaled_error : 2D ndarray or None, optional.
+        If an array is passed, it should be the output of
+        `calc_scaled_errors()` evaluated at `params`, and it will be used
+        instead of recalculating the probabilities and scaled errors.
+        Default == None.
 
     Returns
     -------
@@ -664,37 +864,20 @@ def calc_bhhh_hessian_approximation_mixed_logit(params,
         weights = np.ones(design_3d.shape[0])
     weights_per_obs =\
         np.max(rows_to_mixers.toarray() * weights[:, None], axis=0)
-    # Calculate the regular probability array. Note the implicit assumption
-    # that params == index coefficients.
-    prob_array = general_calc_probabilities(params,
-                                            design_3d,
-                                            alt_IDs,
-                                            rows_to_obs,
-                                            rows_to_alts,
-                                            utility_transform,
-                                            return_long_probs=True)
-
-    # Calculate the simulated probability of correctly predicting each persons
-    # sequence of choices. Note that this function implicitly assumes that the
-    # mixing unit is the individual
-    prob_results = calc_choice_sequence_probs(prob_array,
-                                              choice_vector,
-                                              rows_to_mixers,
-                                              return_type="all")
-    # Calculate the sequence probabilities given random draws
-    # and calculate the overal simulated probabilities
-    sequence_prob_array = prob_results[1]
-    simulated_probs = prob_results[0]
-
-    # Convert the various probabilties to long format
-    long_sequence_prob_array = rows_to_mixers.dot(sequence_prob_array)
-    long_simulated_probs = rows_to_mixers.dot(simulated_probs)
-    # Scale sequence probabilites given random draws by simulated probabilities
-    scaled_sequence_probs = (long_sequence_prob_array /
-                             long_simulated_probs[:, None])
-    # Calculate the scaled error. Will have shape == (num_rows, num_draws)
-    scaled_error = ((choice_vector[:, None] - prob_array) *
-                    scaled_sequence_probs)
+    if scaled_error is None:
+        # Calculate the regular probability array. Note the implicit
+        # assumption that params == index coefficients.
+        prob_array = general_calc_probabilities(params,
+                                                design_3d,
+                                                alt_IDs,
+                                                rows_to_obs,
+                                                rows_to_alts,
+                                                utility_transform,
+                                                return_long_probs=True)
+        # Calculate the scaled error. Will have shape == (num_rows, num_draws)
+        scaled_error = calc_scaled_errors(prob_array,
+                                          choice_vector,
+                                          rows_to_mixers)
 
     # Calculate the gradient. Note that the lines below assume that we are
     # taking the gradient of an MNL model. Should refactor to make use of the
@@ -702,7 +885,8 @@ def calc_bhhh_hessian_approximation_mixed_logit(params,
     # the gradient function for logit-type models to be able to handle 2D
     # systematic utility arrays. `gradient` will have shape
     # (design_3d.shape[0], design_3d.shape[2])
-    gradient = (scaled_error[:, :, None] * design_3d).mean(axis=1)
+    gradient = (np.einsum('id,idk->ik', scaled_error, design_3d) /
+                design_3d.shape[1])
 
     gradient_per_obs = rows_to_mixers.T.dot(gradient)
 
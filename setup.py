@@ -86,7 +86,7 @@ setup(
     # requirements files see:
     # https://packaging.python.org/en/latest/requirements.html
     install_requires=['pandas >= 0.16.2',
-                      'numpy >= 1.10.2',
+                      'numpy >= 1.13.0',
                       'scipy >= 0.16.1',
                       'future >= 0.16',
                       'statsmodels >= 0.6.1',
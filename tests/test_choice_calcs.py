@@ -544,6 +544,51 @@ class ComputationalTests(GenericTestCase):
 
         return None
 
+    def test_calc_probabilities_single_precision_overflow(self):
+        """
+        Ensure that calc_probabilities returns finite, accurate probabilities
+        for single precision utilities that are too large to exponentiate.
+        """
+        # Create a design array whose utilities overflow np.exp in single
+        # precision but not in double precision.
+        large_design = np.array([[300],
+                                 [286],
+                                 [290],
+                                 [-400],
+                                 [3]]) / self.fake_betas[0]
+        expected_index = large_design.dot(self.fake_betas)
+        # Calculate the expected probabilities in double precision, with
+        # the utilities of each individual shifted by their maximum.
+        obs_idx = self.fake_rows_to_obs.nonzero()[1]
+        obs_max = [expected_index[obs_idx == obs].max() for obs in obs_idx]
+        expected_exp_index = np.exp(expected_index - np.array(obs_max))
+        denoms = self.fake_rows_to_obs.T.dot(expected_exp_index)
+        expected_probs = expected_exp_index / self.fake_rows_to_obs.dot(denoms)
+        # Guard against underflow in single precision
+        expected_probs = np.maximum(expected_probs, np.finfo(np.float32).tiny)
+
+        # Alias the function to be tested
+        func = cc.calc_probabilities
+
+        # Collect the arguments needed for this function
+        args = [self.fake_betas.astype(np.float32),
+                large_design.astype(np.float32),
+                self.fake_df[self.alt_id_col].values,
+                self.fake_rows_to_obs.astype(np.float32),
+                self.fake_rows_to_alts.astype(np.float32),
+                self.utility_transform]
+        kwargs = {"intercept_params": self.fake_intercepts,
+                  "shape_params": self.fake_shapes,
+                  "return_long_probs": True}
+        function_results = func(*args, **kwargs)
+
+        # Perform the tests
+        self.assertEqual(function_results.dtype, np.float32)
+        self.assertTrue(np.isfinite(function_results).all())
+        npt.assert_allclose(function_results, expected_probs, rtol=1e-4)
+
+        return None
+
     def test_calc_gradient_no_shapes_no_intercepts(self):
         """
         Ensure that calc_gradient returns the correct values when there are no
@@ -894,6 +939,39 @@ class ComputationalTests(GenericTestCase):
 
         return None
 
+    def test_identity_matrix(self):
+        """
+        Ensure that the IdentityMatrix behaves like a sparse identity matrix
+        in matrix products, and that it returns the other operand unchanged.
+        """
+        num_rows = self.fake_design.shape[0]
+        identity_mat = cc.IdentityMatrix(num_rows)
+        expected_identity = diags(np.ones(num_rows), 0, format='csr')
+
+        self.assertEqual(identity_mat.shape, (num_rows, num_rows))
+        self.assertIs(identity_mat.T, identity_mat)
+        self.assertIs(identity_mat.transpose(), identity_mat)
+        npt.assert_allclose(identity_mat.toarray(),
+                            expected_identity.toarray())
+        npt.assert_allclose(identity_mat.tocsr().toarray(),
+                            expected_identity.toarray())
+
+        # Test the matrix product with dense and sparse arrays
+        design_product = identity_mat.dot(self.fake_design)
+        self.assertIs(design_product, self.fake_design)
+        npt.assert_allclose(design_product,
+                            expected_identity.dot(self.fake_design))
+        npt.assert_allclose(identity_mat.dot(self.fake_rows_to_obs).toarray(),
+                            self.fake_rows_to_obs.toarray())
+
+        # Ensure a ValueError is raised for incompatible shapes
+        self.assertRaisesRegexp(ValueError,
+                                "Dimension mismatch",
+                                identity_mat.dot,
+                                self.fake_design[:-1])
+
+        return None
+
     def test_create_matrix_block_indices(self):
         """
         Ensure that create_matrix_block_indices returns the expected results.
@@ -820,8 +820,9 @@ class ArgumentValidationTests(GenericTestCase):
         """
         # Create an id_array
         id_array = np.array([1, 1, 3, 3, 3, 4, 4, 6, 6, 6, 5])
-        # Create an id array that will contain a value not in the 'unique_ids'
-        null_id_array = np.concatenate([id_array, np.array([-1])], axis=0)
+        # Create an id array that will contain values not in the 'unique_ids',
+        # both smaller and larger than all of the 'unique_ids'.
+        null_id_array = np.concatenate([id_array, np.array([-1, 7])], axis=0)
         # Figure out the original order of appearance of the unique values
         orig_order_unique = np.array([1, 3, 4, 6, 5])
         # Get a generic sorted array of the unique values
@@ -851,7 +852,7 @@ class ArgumentValidationTests(GenericTestCase):
                                    [0, 0, 0, 0, 1],
                                    [0, 0, 0, 1, 0]])
         null_id_mapping =\
-            np.concatenate([sorted_mapping, np.zeros((1, 5))], axis=0)
+            np.concatenate([sorted_mapping, np.zeros((2, 5))], axis=0)
 
         # Alias the function to be tested
         func = ct.create_sparse_mapping
@@ -17,13 +17,6 @@ import numpy.testing as npt
 import pylogit.mixed_logit_calcs as mlc
 import pylogit.mixed_logit as mixed_logit
 
-try:
-    # in Python 3 range returns an iterator instead of list
-    # to maintain backwards compatibility use "old" version of range
-    from past.builtins import xrange
-except ImportError:
-    pass
-
 
 # Use the following to always show the warnings
 np.seterr(all='warn')
@@ -55,6 +48,29 @@ def temp_utility_transform(sys_utility_array, *args, **kwargs):
     return systematic_utilities
 
 
+def ids_to_csr(column_idx, num_cols):
+    """
+    Parameters
+    ----------
+    column_idx : 1D ndarray of ints.
+        Each element should be the (zero-based) column that the corresponding
+        row is mapped to. All elements should be less than `num_cols`.
+    num_cols : int.
+        The number of columns in the resulting mapping matrix.
+
+    Returns
+    -------
+    mapping : 2D scipy.sparse CSR matrix.
+        Will contain only zeros and ones, with a single one in each row at the
+        column given by `column_idx`. The matrix is built directly from its
+        CSR components, without creating a dense intermediate array.
+    """
+    num_rows = column_idx.size
+    data = np.ones(num_rows)
+    indptr = np.arange(num_rows + 1)
+    return csr_matrix((data, column_idx, indptr), shape=(num_rows, num_cols))
+
+
 class NormalDrawsTests(unittest.TestCase):
 
     def test_return_format(self):
@@ -69,6 +85,67 @@ class NormalDrawsTests(unittest.TestCase):
             self.assertIsInstance(draws, np.ndarray)
             self.assertAlmostEqual(draws.shape, (n_obs, n_draws))
 
+        # Repeat the tests with halton draws
+        halton_draws = mlc.get_normal_draws(n_obs,
+                                            n_draws,
+                                            n_vars,
+                                            draw_type="halton")
+        self.assertIsInstance(halton_draws, list)
+        self.assertEqual(len(halton_draws), n_vars)
+        for draws in halton_draws:
+            self.assertIsInstance(draws, np.ndarray)
+            self.assertAlmostEqual(draws.shape, (n_obs, n_draws))
+            self.assertTrue(np.isfinite(draws).all())
+
+        # Ensure that a ValueError is raised for an incorrect draw_type
+        self.assertRaisesRegexp(ValueError,
+                                "draw_type",
+                                mlc.get_normal_draws,
+                                n_obs,
+                                n_draws,
+                                n_vars,
+                                draw_type="foo")
+
+        return None
+
+    def test_halton_draws_accuracy(self):
+        """
+        Ensure that the halton draws integrate the moments of a standard
+        normal distribution more accurately than psuedo-random draws.
+        """
+        n_obs = 100
+        n_draws = 20
+        n_vars = 2
+        kwargs = {"seed": 3}
+        halton_draws = mlc.get_normal_draws(n_obs,
+                                            n_draws,
+                                            n_vars,
+                                            draw_type="halton",
+                                            **kwargs)
+        pseudo_draws = mlc.get_normal_draws(n_obs, n_draws, n_vars, **kwargs)
+
+        for pos in range(n_vars):
+            halton_error = abs((halton_draws[pos]**2).mean() - 1)
+            pseudo_error = abs((pseudo_draws[pos]**2).mean() - 1)
+            self.assertLess(abs(halton_draws[pos].mean()), 1e-2)
+            self.assertLess(halton_error, 1e-2)
+            self.assertLess(halton_error, pseudo_error)
+
+        return None
+
+    def test_get_primes(self):
+        self.assertEqual(mlc.get_primes(1), [2])
+        self.assertEqual(mlc.get_primes(6), [2, 3, 5, 7, 11, 13])
+        return None
+
+    def test_calc_radical_inverse(self):
+        indices = np.arange(1, 7)
+        expected_base_2 = np.array([0.5, 0.25, 0.75, 0.125, 0.625, 0.375])
+        expected_base_3 = np.array([1, 2, 1.0 / 3, 4.0 / 3, 7.0 / 3, 2.0 / 3])
+        npt.assert_allclose(mlc.calc_radical_inverse(indices, 2),
+                            expected_base_2)
+        npt.assert_allclose(mlc.calc_radical_inverse(indices, 3),
+                            expected_base_3 / 3)
         return None
 
 
@@ -130,64 +207,87 @@ class MixedLogitCalculations(unittest.TestCase):
         # Create a fake array of choices
         self.choice_array = np.array([0, 1, 0, 0, 0, 1, 1, 0, 0])
 
-        # Create the 'rows_to_mixers' sparse array for this dataset
-        # Denote the rows that correspond to observation 1 and observation 2
-        self.obs_1_rows = np.ones(self.fake_design.shape[0])
-        # Make sure the rows for observation 2 are given a zero in obs_1_rows
-        self.obs_1_rows[-3:] = 0
-        self.obs_2_rows = 1 - self.obs_1_rows
+        # Denote the mixing unit (i.e. the row of fake_draws) of each row.
+        # Rows 0 - 5 belong to observation 1 and rows 6 - 8 to observation 2.
+        self.mixer_of_row = self.individual_ids - 1
         # Create the row_to_mixers scipy.sparse matrix
-        self.fake_rows_to_mixers = csr_matrix(self.obs_1_rows[:, None] ==
-                                              np.array([1, 0])[None, :])
+        self.fake_rows_to_mixers = ids_to_csr(self.mixer_of_row, 2)
         # Create the rows_to_obs scipy.sparse matrix
-        self.fake_rows_to_obs = csr_matrix(self.situation_ids[:, None] ==
-                                           np.arange(1, 4)[None, :])
+        self.fake_rows_to_obs = ids_to_csr(self.situation_ids - 1, 3)
         # Create the rows_to_alts scipy.sparse matrix
-        self.fake_rows_to_alts = csr_matrix(self.alternative_ids[:, None] ==
-                                            np.arange(1, 4)[None, :])
-
-        # Create the design matrix that we should see for draw 1 and draw 2
-        arrays_to_join = (self.fake_design.copy(),
-                          self.fake_design.copy()[:, -1][:, None])
-        self.fake_design_draw_1 = np.concatenate(arrays_to_join, axis=1)
-        self.fake_design_draw_2 = self.fake_design_draw_1.copy()
-
-        # Multiply the 'random' coefficient draws by the corresponding variable
-        self.fake_design_draw_1[:, -1] *= (self.obs_1_rows *
-                                           self.fake_draws[0, 0] +
-                                           self.obs_2_rows *
-                                           self.fake_draws[1, 0])
-        self.fake_design_draw_2[:, -1] *= (self.obs_1_rows *
-                                           self.fake_draws[0, 1] +
-                                           self.obs_2_rows *
-                                           self.fake_draws[1, 1])
-        extended_design_draw_1 = self.fake_design_draw_1[:, None, :]
-        extended_design_draw_2 = self.fake_design_draw_2[:, None, :]
-        self.fake_design_3d = np.concatenate((extended_design_draw_1,
-                                              extended_design_draw_2),
-                                             axis=1)
-
-        # Create the fake systematic utility values
-        self.sys_utilities_draw_1 = (self.fake_design_draw_1
-                                         .dot(self.fake_betas_ext))
-        self.sys_utilities_draw_2 = (self.fake_design_draw_2
-                                         .dot(self.fake_betas_ext))
+        self.fake_rows_to_alts = ids_to_csr(self.alternative_ids - 1, 3)
+
+        # Create the 3D design matrix that we should see, with one slice of the
+        # second axis per draw. The buffer is allocated once, the original
+        # variables are copied into each draw, and the final column holds the
+        # variable being mixed over multiplied by each row's mixing unit's
+        # 'random' coefficient draws. row_draws will have shape
+        # (num_rows, num_draws).
+        num_rows, num_vars = self.fake_design.shape
+        num_draws = self.fake_draws.shape[1]
+        row_draws = self.fake_draws[self.mixer_of_row, :]
+        self.fake_design_3d = np.empty((num_rows, num_draws, num_vars + 1))
+        self.fake_design_3d[:, :, :-1] = self.fake_design[:, None, :]
+        self.fake_design_3d[:, :, -1] = (self.fake_design[:, -1, None] *
+                                         row_draws)
+
+        # Create views of the design matrix that we should see for draw 1 and
+        # draw 2
+        self.fake_design_draw_1 = self.fake_design_3d[:, 0, :]
+        self.fake_design_draw_2 = self.fake_design_3d[:, 1, :]
+
+        # Create the fake systematic utility values. Will have shape
+        # (num_rows, num_draws). Note this rows-major layout matches the
+        # library, where sparse products handle all draws of a row at once.
+        self.sys_utilities = self.fake_design_3d.dot(self.fake_betas_ext)
 
         #####
         # Calculate the probabilities of each alternatve in each choice
-        # situation
+        # situation, for all draws at once.
         #####
-        long_exp_draw_1 = np.exp(self.sys_utilities_draw_1)
-        long_exp_draw_2 = np.exp(self.sys_utilities_draw_2)
-        ind_exp_sums_draw_1 = self.fake_rows_to_obs.T.dot(long_exp_draw_1)
-        ind_exp_sums_draw_2 = self.fake_rows_to_obs.T.dot(long_exp_draw_2)
-        long_exp_sum_draw_1 = self.fake_rows_to_obs.dot(ind_exp_sums_draw_1)
-        long_exp_sum_draw_2 = self.fake_rows_to_obs.dot(ind_exp_sums_draw_2)
-        long_probs_draw_1 = long_exp_draw_1 / long_exp_sum_draw_1
-        long_probs_draw_2 = long_exp_draw_2 / long_exp_sum_draw_2
-        self.prob_array = np.concatenate((long_probs_draw_1[:, None],
-                                          long_probs_draw_2[:, None]),
-                                         axis=1)
+        # The rows of each choice situation are contiguous, so we can sum over
+        # each situation's rows with np.add.reduceat. Record the first row of
+        # each situation and the situation (i.e. segment) of each row.
+        is_new_situation = np.concatenate(([True],
+                                           self.situation_ids[1:] !=
+                                           self.situation_ids[:-1]))
+        self.situation_starts = np.flatnonzero(is_new_situation)
+        situation_sizes = np.diff(np.append(self.situation_starts,
+                                            self.situation_ids.size))
+        self.situation_of_row = np.repeat(np.arange(situation_sizes.size),
+                                          situation_sizes)
+
+        # Subtract each situation's maximum utility before exponentiating to
+        # avoid overflow. This leaves the probabilities unchanged.
+        ind_max_utilities = np.maximum.reduceat(self.sys_utilities,
+                                                self.situation_starts,
+                                                axis=0)
+        long_exp = np.exp(self.sys_utilities -
+                          ind_max_utilities[self.situation_of_row])
+        ind_exp_sums = np.add.reduceat(long_exp, self.situation_starts, axis=0)
+        long_exp_sums = ind_exp_sums[self.situation_of_row]
+        self.prob_array = long_exp / long_exp_sums
+
+        #####
+        # Calculate the scaled errors that are shared by the gradient and the
+        # BHHH approximation tests
+        #####
+        # Get the simulated probabilities for each individual and get the
+        # array of probabilities given the random draws
+        prob_results = mlc.calc_choice_sequence_probs(self.prob_array,
+                                                      self.choice_array,
+                                                      self.fake_rows_to_mixers,
+                                                      "all")
+        self.simulated_probs = prob_results[0]
+        self.sequence_probs_given_draws = prob_results[1]
+
+        s_twidle = (self.sequence_probs_given_draws /
+                    self.simulated_probs[:, None])
+        long_s_twidle = self.fake_rows_to_mixers.dot(s_twidle)
+        # Scale the difference between the choices and the probabilities of
+        # each row, for each draw.
+        choice_minus_prob = self.choice_array[:, None] - self.prob_array
+        self.error_twidle = choice_minus_prob * long_s_twidle
 
         ###########
         # Create a mixed logit object for later use.
@@ -296,6 +396,26 @@ class MixedLogitCalculations(unittest.TestCase):
 
         return None
 
+    def test_get_row_to_mixer_positions(self):
+        """
+        Ensure that the mixing unit of each row is returned when each row maps
+        to exactly one mixing unit, and that None is returned otherwise.
+        """
+        func = mlc.get_row_to_mixer_positions
+        func_results = func(self.fake_rows_to_mixers)
+        npt.assert_allclose(func_results, self.mixer_of_row)
+
+        # Ensure that dense mapping matrices are handled as well
+        func_results = func(self.fake_rows_to_mixers.toarray())
+        npt.assert_allclose(func_results, self.mixer_of_row)
+
+        # Ensure None is returned if a row is not mapped to any mixing unit
+        bad_mapping = self.fake_rows_to_mixers.toarray()
+        bad_mapping[0, :] = 0
+        self.assertIsNone(func(csr_matrix(bad_mapping)))
+
+        return None
+
     def test_create_expanded_design_for_mixing(self):
         # Create the 3d design matrix using the mixed logit functions
         # Note the [2] denotes the fact that the column at position 2 of the
@@ -309,6 +429,16 @@ class MixedLogitCalculations(unittest.TestCase):
         npt.assert_allclose(actual_3d_design[:, 0, :], self.fake_design_draw_1)
         npt.assert_allclose(actual_3d_design[:, 1, :], self.fake_design_draw_2)
 
+        # Ensure that each mixed column is computed independently of the other
+        # mixed columns. When mixing over column 2 twice, the first mixed
+        # column should exactly equal the single mixed column from above.
+        general_args = [self.fake_design,
+                        [self.fake_draws, self.fake_draws],
+                        [2, 2],
+                        self.fake_rows_to_mixers]
+        general_3d = mlc.create_expanded_design_for_mixing(*general_args)
+        npt.assert_array_equal(actual_3d_design, general_3d[:, :, :-1])
+
         # Ensre that a ValueError is raised if we execute
         # mlc.create_expanded_design_for_mixing with the wrong arguments.
         args[2] = [2, 3, 4]
@@ -438,6 +568,21 @@ class MixedLogitCalculations(unittest.TestCase):
         self.assertEqual(len(sequence_probs_given_draws.shape), 2)
         npt.assert_allclose(actual_sequence_probs, fake_sequence_probs)
 
+        # Ensure that the probabilities of unchosen alternatives do not affect
+        # the results, even when they have underflowed to zero.
+        args[0] = fake_prob_array.copy()
+        args[0][np.where(self.choice_array == 0)] = 0
+        new_sequence_probs = mlc.calc_choice_sequence_probs(*args)[0]
+        npt.assert_allclose(new_sequence_probs, fake_sequence_probs)
+
+        # Ensure that 1D probabilities are treated as coming from one draw
+        args[0] = fake_prob_array[:, 0]
+        one_draw_results = mlc.calc_choice_sequence_probs(*args)
+        self.assertEqual(one_draw_results[1].shape,
+                         (sequence_probs_given_draws.shape[0], 1))
+        npt.assert_allclose(one_draw_results[1].ravel(),
+                            sequence_probs_given_draws[:, 0])
+
         # Ensure that the approrpriate error is raised if we execute
         # calc_choice_sequence_probs() with incorrect arguments.
         args[-1] = "foo"
@@ -500,32 +645,13 @@ class MixedLogitCalculations(unittest.TestCase):
         return None
 
     def test_calc_mixed_logit_gradient(self):
-        # Get the simulated probabilities for each individual and get the
-        # array of probabilities given the random draws
-        # Calculate the actual, simulated sequence probabilities
-        args = (self.prob_array,
-                self.choice_array,
-                self.fake_rows_to_mixers,
-                "all")
-        prob_results = mlc.calc_choice_sequence_probs(*args)
-        simulated_probs = prob_results[0]
-        sequence_probs_given_draws = prob_results[1]
+        # Alias the scaled errors that were calculated in setUp
+        error_twidle = self.error_twidle
 
-        s_twidle = sequence_probs_given_draws / simulated_probs[:, None]
-        long_s_twidle = self.fake_rows_to_mixers.dot(s_twidle)
-        error_twidle = ((self.choice_array[:, None] -
-                         self.prob_array) *
-                        long_s_twidle)
-
-        # Initialize the true gradient
-        gradient = np.zeros(self.fake_design_3d.shape[2])
-
-        # Calculate the true gradient in an inefficient but clearly correct way
-        for i in xrange(self.fake_design.shape[0]):
-            for d in xrange(self.prob_array.shape[1]):
-                gradient += (error_twidle[i, d] *
-                             self.fake_design_3d[i, d, :])
-        gradient *= 1.0 / self.prob_array.shape[1]
+        # Calculate the true gradient by summing the scaled errors times the
+        # design matrix over all rows and draws, then averaging over draws.
+        gradient = (np.einsum('id,idk->k', error_twidle, self.fake_design_3d) /
+                    self.prob_array.shape[1])
 
         # Get the gradient from the function being tested
         args = [self.fake_betas_ext,
@@ -545,6 +671,11 @@ class MixedLogitCalculations(unittest.TestCase):
                          self.fake_design_3d.shape[2])
         npt.assert_allclose(gradient, function_gradient)
 
+        # Ensure that precomputed scaled errors are used when passed
+        npt.assert_allclose(gradient,
+                            mlc.calc_mixed_logit_gradient(
+                                *args, scaled_error=self.error_twidle))
+
         # Test the function with a ridge penalty
         ridge_penalty = 2 * self.ridge * self.fake_betas_ext
         new_gradient = gradient - ridge_penalty
@@ -574,42 +705,26 @@ class MixedLogitCalculations(unittest.TestCase):
         return None
 
     def test_calc_bhhh_hessian_approximation_mixed_logit(self):
-        # Get the simulated probabilities for each individual and get the
-        # array of probabilities given the random draws
-        # Calculate the actual, simulated sequence probabilities
-        args = (self.prob_array,
-                self.choice_array,
-                self.fake_rows_to_mixers,
-                "all")
-        prob_results = mlc.calc_choice_sequence_probs(*args)
-        simulated_probs = prob_results[0]
-        sequence_probs_given_draws = prob_results[1]
-
-        s_twidle = sequence_probs_given_draws / simulated_probs[:, None]
-        long_s_twidle = self.fake_rows_to_mixers.dot(s_twidle)
-        error_twidle = ((self.choice_array[:, None] -
-                         self.prob_array) *
-                        long_s_twidle)
+        # Alias the scaled errors that were calculated in setUp
+        error_twidle = self.error_twidle
 
         # Initialize the true gradient, with one row per individual
-        gradient = np.zeros((simulated_probs.shape[0],
+        gradient = np.zeros((self.simulated_probs.shape[0],
                              self.fake_design_3d.shape[2]))
 
-        # Calculate the true gradient in an inefficient but clearly correct way
-        for pos, i in enumerate(self.individual_ids):
-            for d in xrange(self.prob_array.shape[1]):
-                gradient[i - 1, :] += (error_twidle[pos, d] *
-                                       self.fake_design_3d[pos, d, :])
+        # Calculate each row's contribution to the gradient, summed over draws,
+        # and then accumulate the contributions of each individual's rows.
+        row_contributions = np.einsum('id,idk->ik',
+                                      error_twidle,
+                                      self.fake_design_3d)
+        np.add.at(gradient, self.individual_ids - 1, row_contributions)
         gradient *= 1.0 / self.prob_array.shape[1]
 
-        # Calculate the bhhh matrix
-        bhhh_matrix = np.zeros((self.fake_design_3d.shape[2],
-                                self.fake_design_3d.shape[2]))
-        for i in xrange(gradient.shape[0]):
-            bhhh_matrix += np.outer(gradient[i, :], gradient[i, :])
-        # Multiply by negative one to account for the fact that we're
-        # approximating the Fisher Information Matrix
-        bhhh_matrix *= -1
+        # Calculate the bhhh matrix, i.e. the sum of the outer products of each
+        # individual's gradient with itself. Multiply by negative one to
+        # account for the fact that we're approximating the Fisher Information
+        # Matrix
+        bhhh_matrix = -1 * gradient.T.dot(gradient)
 
         # Get the bhhh matrix from the function being tested
         args = [self.fake_betas_ext,
@@ -631,6 +746,11 @@ class MixedLogitCalculations(unittest.TestCase):
                          self.fake_design_3d.shape[2])
         npt.assert_allclose(bhhh_matrix, function_bhhh)
 
+        # Ensure that precomputed scaled errors are used when passed
+        func = mlc.calc_bhhh_hessian_approximation_mixed_logit
+        npt.assert_allclose(bhhh_matrix,
+                            func(*args, scaled_error=self.error_twidle))
+
         # Perform the test with the ridge coefficient
         args.append(self.ridge)
         func_res2 = mlc.calc_bhhh_hessian_approximation_mixed_logit(*args)
@@ -659,6 +779,27 @@ class MixedLogitCalculations(unittest.TestCase):
 
         return None
 
+    def test_calc_scaled_errors(self):
+        """
+        Ensure that the scaled errors are correctly calculated, and that the
+        mixed logit estimator caches them for the most recent parameters.
+        """
+        func_results = mlc.calc_scaled_errors(self.prob_array,
+                                              self.choice_array,
+                                              self.fake_rows_to_mixers)
+        self.assertEqual(func_results.shape, self.prob_array.shape)
+        npt.assert_allclose(func_results, self.error_twidle)
+
+        # Ensure the estimator's results are cached between calls at the same
+        # parameters and recalculated for different parameters.
+        func = self.estimator.convenience_calc_scaled_errors
+        first_results = func(self.fake_betas_ext)
+        npt.assert_allclose(first_results, self.error_twidle)
+        self.assertIs(func(self.fake_betas_ext.copy()), first_results)
+        self.assertIsNot(func(self.fake_betas_ext + 1), first_results)
+
+        return None
+
     def test_panel_predict(self):
         # Specify settings for the test (including seed for reproducibility)
         chosen_seed = 912
@@ -693,14 +834,11 @@ class MixedLogitCalculations(unittest.TestCase):
                                              seed=chosen_seed)
 
         # Create the new rows_to_mixers for the observations being predicted
-        new_row_to_mixer = csr_matrix(new_obs_ids[:, None] ==
-                                      np.array([1, 3])[None, :])
+        new_row_to_mixer = ids_to_csr(np.where(new_obs_ids == 1, 0, 1), 2)
         # Create the new rows_to_obs for the observations being predicted
-        new_rows_to_obs = csr_matrix(new_situation_ids[:, None] ==
-                                     np.array([1, 2, 3])[None, :])
+        new_rows_to_obs = ids_to_csr(new_situation_ids - 1, 3)
         # Create the new rows_to_alts for the observations being predicted
-        new_rows_to_alts = csr_matrix(new_alt_ids[:, None] ==
-                                      np.array([1, 2, 3])[None, :])
+        new_rows_to_alts = ids_to_csr(new_alt_ids - 1, 3)
 
         # Create the new 3D design matrix
         new_design_3d = mlc.create_expanded_design_for_mixing(new_design,
@@ -732,20 +870,18 @@ class MixedLogitCalculations(unittest.TestCase):
         # previously recorded choices for.
         ##########
         # Note rel_old_idx should be np.array([T, T, T, T, T, T, F, F, F])
-        rel_old_idx = np.in1d(self.individual_ids, new_obs_ids)
+        rel_old_idx = np.isin(self.individual_ids, new_obs_ids)
         # rel_old_matrix_2d should have shape (6, 3)
         rel_old_matrix_2d = self.fake_design[rel_old_idx, :]
-        rel_old_mixing_var = rel_old_matrix_2d[:, -1][:, None]
-        # rel_old_matrix_ext_2d should have shape (6, 4)
-        rel_old_matrix_ext_2d = np.concatenate((rel_old_matrix_2d,
-                                                rel_old_mixing_var), axis=1)
-        # rel_old_matrix_3d should have shape (6, 3, 4)
-        rel_old_matrix_3d = np.tile(rel_old_matrix_ext_2d[:, None, :],
-                                    (1, num_test_draws, 1))
-        # random_vals should have shape(6, 3)
-        random_vals = np.tile(new_draw_list[0][0, :][None, :],
-                              (rel_old_matrix_3d.shape[0], 1))
-        rel_old_matrix_3d[:, :, -1] *= random_vals
+        # rel_old_matrix_3d should have shape (6, 3, 4). The last column is a
+        # copy of the mixing variable that will be multiplied by the draws.
+        rel_old_matrix_3d = np.empty((rel_old_matrix_2d.shape[0],
+                                      num_test_draws,
+                                      rel_old_matrix_2d.shape[1] + 1))
+        rel_old_matrix_3d[:, :, :-1] = rel_old_matrix_2d[:, None, :]
+        rel_old_matrix_3d[:, :, -1] = rel_old_matrix_2d[:, -1][:, None]
+        # Broadcast the individual's draws, of shape (1, 3), across all rows
+        rel_old_matrix_3d[:, :, -1] *= new_draw_list[0][0, :][None, :]
 
         ##########
         # Get the array of kernel probabilities for each individual for whom we
@@ -817,7 +953,9 @@ class MixedLogitCalculations(unittest.TestCase):
         # Calcluate the final probabilities per situation using the
         # individualized coefficients
         ##########
-        true_pred_probs = (weights_per_draw * new_kernel_probs).sum(axis=1)
+        true_pred_probs = np.einsum('id,id->i',
+                                    weights_per_draw,
+                                    new_kernel_probs)
         # Calculate the probabilities per situation without individualized
         # coefficients
         wrong_pred_probs = new_kernel_probs.mean(axis=1)
@@ -881,6 +1019,50 @@ class MixedLogitCalculations(unittest.TestCase):
         # Ensure that all variations of the returned chosen probs are correct
         npt.assert_allclose(second_chosen_probs, function_chosen_probs)
 
+        # Ensure that the predictions are accurate when using single precision
+        # floating point numbers for the kernel probability calculations
+        fp32_pred_probs = self.mixl_obj.panel_predict(predictive_df,
+                                                      num_test_draws,
+                                                      seed=chosen_seed,
+                                                      dtype=np.float32)
+        self.assertEqual(fp32_pred_probs.dtype, np.float32)
+        npt.assert_allclose(true_pred_probs, fp32_pred_probs, rtol=1e-5)
+
+        # Ensure that single precision predictions remain finite and accurate
+        # when the utilities are too large to exponentiate in single precision
+        self.mixl_obj.coefs = pd.Series(60 * self.fake_betas_ext)
+        large_pred_probs = self.mixl_obj.panel_predict(predictive_df,
+                                                       num_test_draws,
+                                                       seed=chosen_seed)
+        fp32_large_pred_probs =\
+            self.mixl_obj.panel_predict(predictive_df,
+                                        num_test_draws,
+                                        seed=chosen_seed,
+                                        dtype=np.float32)
+        self.mixl_obj.coefs = pd.Series(self.fake_betas_ext)
+        self.assertTrue(np.isfinite(fp32_large_pred_probs).all())
+        npt.assert_allclose(large_pred_probs,
+                            fp32_large_pred_probs,
+                            atol=1e-5,
+                            rtol=1e-4)
+
+        # Ensure that predictions can be made with a single draw, in which
+        # case the kernel probabilities are 1D.
+        one_draw_pred_probs = self.mixl_obj.panel_predict(predictive_df,
+                                                          1,
+                                                          seed=chosen_seed)
+        self.assertEqual(one_draw_pred_probs.shape, (new_design.shape[0],))
+        npt.assert_allclose(new_rows_to_obs.T.dot(one_draw_pred_probs),
+                            np.ones(new_rows_to_obs.shape[1]))
+
+        # Ensure that a ValueError is raised for a non-floating point dtype
+        self.assertRaisesRegexp(ValueError,
+                                "dtype",
+                                self.mixl_obj.panel_predict,
+                                predictive_df,
+                                num_test_draws,
+                                dtype=int)
+
         # Make sure the appropriate errors are raised when the input dataframe
         # is missing needed columns
         new_predictive_df = predictive_df.copy()
@@ -1173,4 +1355,24 @@ class MixedLogitCalculations(unittest.TestCase):
 
         self.mixl_obj.fit_mle(init_vals, num_draws, seed=seed)
 
+        # Ensure that estimation also works with halton draws, and that it
+        # reaches the same fit as psuedo-random draws. Note the fake data is
+        # perfectly separable, so the estimated coefficients diverge and only
+        # the log-likelihoods can be compared.
+        num_draws = 10
+        self.mixl_obj.fit_mle(init_vals,
+                              num_draws,
+                              seed=seed,
+                              print_res=False)
+        pseudo_log_likelihood = self.mixl_obj.log_likelihood
+        self.mixl_obj.fit_mle(init_vals,
+                              num_draws,
+                              seed=seed,
+                              draw_type="halton",
+                              print_res=False)
+        self.assertTrue(np.isfinite(self.mixl_obj.params.values).all())
+        npt.assert_allclose(self.mixl_obj.log_likelihood,
+                            pseudo_log_likelihood,
+                            rtol=1e-5)
+
         return None